@@ -1,3 +1,4 @@
+import concurrent.futures
 import logging
 import os
 import praw
@@ -9,9 +10,12 @@ import time
 import traceback
 import warnings
 
-from bs4 import BeautifulSoup
-from html.parser import unescape
+from threading import BoundedSemaphore
+from html import unescape
+from lxml import html as lxml_html
+from requests.adapters import HTTPAdapter
 from urllib.parse import urlencode
+from urllib3.util.retry import Retry
 from praw.helpers import flatten_tree
 
 from praw.errors import APIException, ClientException, HTTPException
@@ -25,15 +29,21 @@ DB_FILE = os.environ.get("DATABASE", "snapshill.sqlite3")
 LEN_MAX = 35
 REDDIT_API_WAIT = 2
 WARN_TIME = 300 # warn after spending 5 minutes on a post
+TIMEOUT = (5, 30)  # (connect, read) seconds for archive site requests
+COOLDOWN = 120  # skip an archive site for 2 minutes after it fails
 REDDIT_PATTERN = re.compile("https?://(([A-z]{2})(-[A-z]{2})"
                             "?|beta|i|m|pay|ssl|www)\.?reddit\.com")
-SUBREDDIT_OR_USER = re.compile("/(u|user|r)/[^\/]+/?$")
+SKIP_RE = re.compile(r"^https?://(?:[A-Za-z]{2}(?:-[A-Za-z]{2})?|beta|i|m|pay|"
+                     r"ssl|www)\.?reddit\.com/(?:u|user|r)/[^/]+/?$")
+ARCHIVE_IS_RE = re.compile(r"https?://archive\.is/[0-9A-Za-z]{1,6}")
+QUOTES_SPLIT_RE = re.compile(r"\r\n-{3,}\r\n")
 # we have to do some manual ratelimiting because we are tunnelling through
 # some other websites.
 
 RECOVERABLE_EXC = (APIException,
                    ClientException,
                    HTTPException)
+ARCHIVE_EXC = RECOVERABLE_EXC + (requests.RequestException,)
 
 
 loglevel = logging.DEBUG if os.environ.get("DEBUG") == "true" else logging.INFO
@@ -47,6 +57,16 @@ warnings.simplefilter("ignore")  # Ignore ResourceWarnings (because screw them)
 
 r = praw.Reddit(USER_AGENT)
 ignorelist = set()
+cooldown_until = {}  # site name -> time we can try archiving there again
+post_ts = ""  # archive.org timestamp, refreshed for each submission
+
+s = requests.Session()
+s.headers["User-Agent"] = USER_AGENT
+adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64,
+                      max_retries=Retry(total=3, backoff_factor=0.3,
+                                        status_forcelist=(502, 503, 504)))
+s.mount("https://", adapter)
+s.mount("http://", adapter)
 
 
 def get_footer():
@@ -57,13 +77,11 @@ def get_footer():
 def should_notify(submission):
     """
     Looks for other snapshot bot comments in the comment chain and doesn't
-    post if they do.
+    post if they do. Submissions we already replied to are filtered out by
+    the caller before this is reached.
     :param submission: Submission to check
     :return: If we should comment or not
     """
-    cur.execute("SELECT * FROM links WHERE id=?", (submission.name,))
-    if cur.fetchone():
-        return False
     submission.replace_more_comments()
     for comment in flatten_tree(submission.comments):
         if comment.author and comment.author.name in ignorelist:
@@ -71,8 +89,13 @@ def should_notify(submission):
     return True
 
 
+def _maybe_reddit(url):
+    # cheap substring check so most links never reach REDDIT_PATTERN
+    return "reddit.com" in url
+
+
 def ratelimit(url):
-    if len(re.findall(REDDIT_PATTERN, url)) == 0:
+    if not _maybe_reddit(url) or REDDIT_PATTERN.search(url) is None:
         return
     time.sleep(REDDIT_API_WAIT)
 
@@ -93,17 +116,28 @@ def fix_url(url):
     """
     if url.startswith("r/") or url.startswith("u/"):
         url = "http://www.reddit.com" + url
-    return re.sub(REDDIT_PATTERN, "http://www.reddit.com", url)
+    if not _maybe_reddit(url):
+        return url
+    return REDDIT_PATTERN.sub("http://www.reddit.com", url)
+
+
+def rehost(url, host):
+    """
+    Swap the reddit host of a URL for another site's.
+    :param url: reddit URL, usually already normalized by fix_url
+    :param host: Scheme and host to use instead
+    :return: The URL on the new host
+    """
+    if url.startswith("http://www.reddit.com"):
+        return url.replace("http://www.reddit.com", host, 1)
+    return REDDIT_PATTERN.sub(host, url)
 
 
 def skip_url(url):
     """
     Skip naked username mentions and subreddit links.
     """
-    if REDDIT_PATTERN.match(url) and SUBREDDIT_OR_USER.search(url):
-        return True
-
-    return False
+    return _maybe_reddit(url) and SKIP_RE.match(url) is not None
 
 
 def log_error(e):
@@ -111,6 +145,19 @@ def log_error(e):
                                           traceback.format_exc()))
 
 
+def in_cooldown(site_name):
+    return cooldown_until.get(site_name, 0) > time.time()
+
+
+def cool_down(site_name):
+    """
+    Stops sending requests to a site for a while. Only for failures of the
+    site itself, not for a single URL it won't archive.
+    """
+    log.debug("{} failed, cooling down".format(site_name))
+    cooldown_until[site_name] = time.time() + COOLDOWN
+
+
 class NameMixin:
     site_name = None
 
@@ -127,7 +174,7 @@ class ArchiveIsArchive(NameMixin):
 
     def __init__(self, url):
         self.url = url
-        self.archived = self.archive()
+        self.archived = False
         pairs = {"url": self.url, "run": 1}
         self.error_link = "https://archive.is/?" + urlencode(pairs)
 
@@ -140,16 +187,43 @@ class ArchiveIsArchive(NameMixin):
         pairs = {"url": self.url}
 
         try:
-            res = requests.post("https://archive.is/submit/", pairs, verify=False)
-        except RECOVERABLE_EXC:
+            res = s.post("https://archive.is/submit/", pairs, verify=False,
+                         timeout=TIMEOUT, stream=True)
+        except ARCHIVE_EXC:
+            cool_down(self.site_name)
             return False
 
-        found = re.findall("http[s]?://archive.is/[0-z]{1,6}", res.text)
-
-        if len(found) < 1:
+        try:
+            return self._find_link(res)
+        except ARCHIVE_EXC:
+            cool_down(self.site_name)
             return False
+        finally:
+            res.close()
 
-        return found[0]
+    @staticmethod
+    def _find_link(res):
+        """
+        Scans the response as it downloads and stops at the first archive
+        link, so we don't have to read the whole page.
+        :param res: Streamed response from archive.is
+        :return: URL of the archive or False if there isn't one
+        """
+        res.encoding = res.encoding or "utf-8"
+        tail = ""
+
+        for chunk in res.iter_content(chunk_size=8192, decode_unicode=True):
+            window = tail + chunk
+            found = ARCHIVE_IS_RE.search(window)
+
+            # a match running up to the end may continue in the next chunk
+            if found and found.end() < len(window):
+                return found.group(0)
+
+            tail = window[-40:]
+
+        found = ARCHIVE_IS_RE.search(tail)
+        return found.group(0) if found else False
 
 
 class ArchiveOrgArchive(NameMixin):
@@ -157,7 +231,7 @@ class ArchiveOrgArchive(NameMixin):
 
     def __init__(self, url):
         self.url = url
-        self.archived = self.archive()
+        self.archived = False
         self.error_link = "https://web.archive.org/save/" + self.url
 
     def archive(self):
@@ -168,13 +242,20 @@ class ArchiveOrgArchive(NameMixin):
         we cannot archive this page.
         """
         try:
-            requests.get("https://web.archive.org/save/" + self.url)
-        except RECOVERABLE_EXC as e:
-            if isinstance(e, HTTPError) and e.status_code == 403:
-                return None
+            res = s.get("https://web.archive.org/save/" + self.url,
+                        timeout=TIMEOUT)
+            res.raise_for_status()
+        except ARCHIVE_EXC as e:
+            if isinstance(e, requests.HTTPError):
+                if e.response.status_code == 403:
+                    return None
+                if e.response.status_code < 500:
+                    return False  # a problem with this URL, not the site
+            cool_down(self.site_name)
             return False
-        date = time.strftime(ARCHIVE_ORG_FORMAT, time.gmtime())
-        return "https://web.archive.org/" + date + "/" + self.url
+        # archive.org redirects to the closest snapshot, so the time we
+        # started on this submission is close enough
+        return "https://web.archive.org/" + post_ts + "/" + self.url
 
 
 class MegalodonJPArchive(NameMixin):
@@ -182,7 +263,7 @@ class MegalodonJPArchive(NameMixin):
 
     def __init__(self, url):
         self.url = url
-        self.archived = self.archive()
+        self.archived = False
         self.error_link = "http://megalodon.jp/pc/get_simple/decide?url={}".format(self.url)
 
     def archive(self):
@@ -194,9 +275,10 @@ class MegalodonJPArchive(NameMixin):
         """
         pairs = {"url": self.url}
         try:
-            res = requests.post("http://megalodon.jp/pc/get_simple/decide",
-                                pairs)
-        except RECOVERABLE_EXC:
+            res = s.post("http://megalodon.jp/pc/get_simple/decide", pairs,
+                         timeout=TIMEOUT)
+        except ARCHIVE_EXC:
+            cool_down(self.site_name)
             return False
         if res.url == "http://megalodon.jp/pc/get_simple/decide":
             return False
@@ -208,7 +290,7 @@ class GoldfishArchive(NameMixin):
 
     def __init__(self, url):
         self.url = url
-        self.archived = re.sub(REDDIT_PATTERN, "https://snew.github.io", url)
+        self.archived = rehost(url, "https://snew.github.io")
         self.error_link = "https://snew.github.io/"
 
 class RemovedditArchive(NameMixin):
@@ -216,7 +298,7 @@ class RemovedditArchive(NameMixin):
 
     def __init__(self, url):
         self.url = url
-        self.archived = re.sub(REDDIT_PATTERN, "https://www.removeddit.com", url)
+        self.archived = rehost(url, "https://www.removeddit.com")
         self.error_link = "https://www.removeddit.com/"
 
 class ArchiveContainer:
@@ -224,14 +306,70 @@ class ArchiveContainer:
         log.debug("Creating ArchiveContainer")
         self.url = url
         self.text = (text[:LEN_MAX] + "...") if len(text) > LEN_MAX else text
+        self.rendered = ""
         self.archives = [ArchiveOrgArchive(url),
                          MegalodonJPArchive(url)]
 
-        if re.match(REDDIT_PATTERN, url):
+        if _maybe_reddit(url) and REDDIT_PATTERN.match(url):
             self.archives.append(RemovedditArchive(url))
 
         self.archives.append(ArchiveIsArchive(url))
 
+    def run(self):
+        """
+        Queues this link up on the remote archive sites.
+        :return: Futures which complete once each archive is done
+        """
+        return [pool.submit(_archive, archive) for archive in self.archives
+                if archive.site_name in site_locks]
+
+    def render(self):
+        """
+        Formats the archive links for the reply once archiving is done, so
+        building the comment only has to join them up.
+        """
+        # None means the site refused this page, so it isn't listed
+        good = [a for a in self.archives if a.archived is not None]
+        if not good:
+            self.rendered = "*no archives available*"
+            return
+
+        subparts = []
+        for archive in good:
+            archive_link = archive.archived
+
+            if not archive_link:
+                log.debug("Not found, using error link")
+                archive_link = archive.error_link + ' "could not ' \
+                                                    'auto-archive; ' \
+                                                    'click to resubmit it!"'
+            else:
+                log.debug("Found archive")
+
+            subparts.append(f"[{archive.name}]({archive_link})")
+
+        self.rendered = ", ".join(subparts)
+
+
+# only one request at a time per site, so we don't hammer any of them
+site_locks = {cls.site_name: BoundedSemaphore(1) for cls in
+              (ArchiveIsArchive, ArchiveOrgArchive, MegalodonJPArchive)}
+# the locks cap us at one request per site, so more threads would only wait
+pool = concurrent.futures.ThreadPoolExecutor(len(site_locks))
+
+
+def _archive(archive):
+    with site_locks[archive.site_name]:
+        # a site in cooldown keeps its resubmit link but isn't contacted
+        if in_cooldown(archive.site_name):
+            return
+
+        archive.archived = archive.archive()
+        if archive.archived is False:
+            return
+
+        ratelimit(archive.url)
+
 
 class Notification:
 
@@ -245,7 +383,7 @@ class Notification:
         Replies with a comment containing the archives or if there are too
         many links to fit in a comment, post a submisssion to
         /r/SnapshillBotEx and then make a comment linking to it.
-        :return Nothing
+        :return Full name of our reply, or None if we couldn't post it
         """
         try:
             comment = self._build()
@@ -264,36 +402,14 @@ class Notification:
                 comment = self.post.add_comment(comment)
         except RECOVERABLE_EXC as e:
             log_error(e)
-            return
-        cur.execute("INSERT INTO links (id, reply) VALUES (?, ?)",
-                    (self.post.name, comment.name))
+            return None
+        return comment.name
 
     def _build(self):
         parts = [self.header.get(), "Snapshots:"]
-        format = "[{name}]({archive})"
 
         for i, link in enumerate(self.links, 1):
-            subparts = []
-            log.debug("Found link")
-
-            for archive in link.archives:
-                if archive.archived is None:
-                    continue
-
-                archive_link = archive.archived
-
-                if not archive_link:
-                    log.debug("Not found, using error link")
-                    archive_link = archive.error_link + ' "could not ' \
-                                                        'auto-archive; ' \
-                                                        'click to resubmit it!"'
-                else:
-                    log.debug("Found archive")
-
-                subparts.append(format.format(name=archive.name,
-                                              archive=archive_link))
-
-            parts.append("{}. {} - {}".format(i, link.text, ", ".join(subparts)))
+            parts.append(f"{i}. {link.text} - {link.rendered}")
 
         parts.append(get_footer())
 
@@ -330,7 +446,7 @@ class Header:
         return self._settings.get_wiki_page("extxt/" + self.subreddit.lower()).content_md
 
     def _parse_quotes(self, quotes_str):
-        return [q.strip() for q in re.split('\r\n-{3,}\r\n', quotes_str) if q.strip()]
+        return [q.strip() for q in QUOTES_SPLIT_RE.split(quotes_str) if q.strip()]
 
 
 class Snapshill:
@@ -350,55 +466,89 @@ class Snapshill:
         if not self._setup:
             raise Exception("Snapshiller not ready yet!")
 
-        submissions = r.get_new(limit=self.limit)
+        submissions = list(r.get_new(limit=self.limit))
+        ids = [submission.name for submission in submissions]
+        cur.execute("SELECT id FROM links WHERE id IN ({})".format(
+            ",".join("?" * len(ids))), ids)
+        seen = {row[0] for row in cur.fetchall()}
+        pending_writes = []
 
-        for submission in submissions:
-            debugTime = time.time()
-            warned = False
-
-            log.debug("Found submission.\n" + submission.permalink)
+        try:
+            for submission in submissions:
+                log.debug("Found submission.\n" + submission.permalink)
 
-            if not should_notify(submission):
-                log.debug("Skipping.")
-                continue
+                try:
+                    if submission.name in seen or \
+                            not should_notify(submission):
+                        log.debug("Skipping.")
+                        continue
 
-            archives = [ArchiveContainer(fix_url(submission.url),
-                                         "*This Post*")]
-            if submission.is_self and submission.selftext_html is not None:
-                log.debug("Found text post...")
+                    reply = self._archive_submission(submission)
+                    if reply:
+                        pending_writes.append((submission.name, reply))
+                except RECOVERABLE_EXC as e:
+                    log_error(e)
+        finally:
+            # one batched insert and commit per cycle rather than one per post
+            cur.executemany("INSERT OR IGNORE INTO links (id, reply) "
+                            "VALUES (?, ?)", pending_writes)
+            db.commit()
 
-                links = BeautifulSoup(unescape(
-                    submission.selftext_html)).find_all("a")
+    def _archive_submission(self, submission):
+        """
+        Archives the submission and any links in its text, then replies.
+        :param submission: Submission to archive
+        :return: Full name of our reply, or None if we didn't reply
+        """
+        global post_ts
+        post_ts = time.strftime(ARCHIVE_ORG_FORMAT, time.gmtime())
 
-                if not len(links):
-                    continue
+        post_url = fix_url(submission.url)
+        archives = [ArchiveContainer(post_url, "*This Post*")]
+        if submission.is_self and submission.selftext_html is not None:
+            log.debug("Found text post...")
 
-                finishedURLs = []
+            # reddit sends selftext_html entity-escaped, so it must be
+            # unescaped once before parsing
+            links = lxml_html.fromstring(unescape(
+                submission.selftext_html)).xpath("//a[@href]")
 
-                for anchor in links:
-                    if time.time() > debugTime + WARN_TIME and not warned:
-                        log.warn("Spent over {} seconds on post (ID: {})".format(
-                            WARN_TIME, submission.name))
+            if not len(links):
+                return None
 
-                        warned = True
+            seen_urls = {post_url}
 
-                    log.debug("Found link in text post...")
+            for anchor in links:
+                log.debug("Found link in text post...")
 
-                    url = fix_url(anchor['href'])
+                url = fix_url(anchor.get("href"))
 
-                    if skip_url(url):
-                        continue
+                if skip_url(url):
+                    continue
 
-                    if url in finishedURLs:
-                        continue #skip for sanity
+                if url in seen_urls:
+                    continue #skip for sanity
 
-                    archives.append(ArchiveContainer(url, anchor.contents[0]))
-                    finishedURLs.append(url)
-                    ratelimit(url)
+                archives.append(ArchiveContainer(url, anchor.text_content()))
+                seen_urls.add(url)
 
-            Notification(submission, self._get_header(submission.subreddit),
-                         archives).notify()
-            db.commit()
+        futures = [f for container in archives for f in container.run()]
+        try:
+            if concurrent.futures.wait(futures, timeout=WARN_TIME).not_done:
+                log.warn("Spent over {} seconds on post (ID: {})".format(
+                    WARN_TIME, submission.name))
+            for future in futures:
+                future.result()
+        finally:
+            # don't leave queued archives behind if we're interrupted
+            for future in futures:
+                future.cancel()
+        for container in archives:
+            container.render()
+
+        return Notification(submission,
+                            self._get_header(submission.subreddit),
+                            archives).notify()
 
     def setup(self):
         """
@@ -412,6 +562,7 @@ class Snapshill:
     def quit(self):
         self.headers = {}
         self._setup = False
+        pool.shutdown(wait=False)
 
     def refresh_headers(self):
         """
@@ -441,8 +592,18 @@ class Snapshill:
         return self.headers.get(subreddit.display_name.lower(), all)
 
 
-db = sqlite3.connect(DB_FILE)
+db = sqlite3.connect(DB_FILE, isolation_level="DEFERRED",
+                     check_same_thread=False)
 cur = db.cursor()
+cur.executescript("PRAGMA journal_mode=WAL;"
+                  "PRAGMA synchronous=NORMAL;"
+                  "PRAGMA temp_store=MEMORY;"
+                  "PRAGMA cache_size=-64000;"
+                  "PRAGMA busy_timeout=5000;"
+                  "CREATE TABLE IF NOT EXISTS links"
+                  "(id TEXT PRIMARY KEY, reply TEXT) WITHOUT ROWID;"
+                  # older databases already have the table without a key
+                  "CREATE UNIQUE INDEX IF NOT EXISTS links_id ON links(id);")
 
 if __name__ == "__main__":
     username = os.environ.get("REDDIT_USER")